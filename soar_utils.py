@@ -3,12 +3,15 @@
 from abc import abstractmethod
 from argparse import ArgumentParser
 from ast import literal_eval
+from collections import defaultdict
 from contextlib import contextmanager
 from copy import deepcopy
 from imp import load_module
 from inspect import Parameter, signature
 from itertools import chain, product
+from math import frexp
 from os.path import exists, join
+from time import perf_counter
 from types import GeneratorType
 import re
 import sys
@@ -30,20 +33,19 @@ import Python_sml_ClientInterface as sml
 
 class Agent:
     class Identifier:
-        def __init__(self, agent, wme):
+        def __init__(self, agent, wme, time_tag):
             assert isinstance(wme, sml.Identifier)
             self.agent = agent
             self.wme = wme
+            # an identifier's time tag never changes, so hashing needs no SML call
+            self.time_tag = time_tag
         def __eq__(self, other):
             return isinstance(other, Agent.Identifier) and hash(self) == hash(other)
         def __hash__(self):
             return self.time_tag
-        @property
-        def time_tag(self):
-            return self.wme.GetTimeTag()
         def children(self):
-            for index in range(self.wme.GetNumberChildren()):
-                yield self.agent._get_wme(self.wme.GetChild(index))
+            for index in range(self.agent._sml(self.wme.GetNumberChildren)):
+                yield self.agent._get_wme(self.agent._sml(self.wme.GetChild, index))
         def add_child(self, attribute, value):
             self.agent.create_wme(self, attribute, value)
     class WME:
@@ -53,19 +55,19 @@ class Agent:
             self.wme = wme
         @property
         def identifier(self):
-            return self.agent._get_identifier(self.wme.ConvertToIdentifier())
+            return self.agent._get_identifier(self.agent._sml(self.wme.ConvertToIdentifier))
         @property
         def attribute(self):
-            return str(self.wme.GetAttribute())
+            return str(self.agent._sml(self.wme.GetAttribute))
         @property
         def value_type(self):
-            value_type = self.wme.GetValueType()
+            value_type = self.agent._sml(self.wme.GetValueType)
             if value_type == "int":
                 return int
             elif value_type == "float":
                 return float
             elif value_type == "string":
-                value = self.wme.ConvertToStringElement().GetValue()
+                value = self.agent._sml(self.agent._sml(self.wme.ConvertToStringElement).GetValue)
                 if value in ("true", "false"):
                     return bool
                 else:
@@ -74,38 +76,47 @@ class Agent:
                 return Agent.Identifier
         @property
         def value(self):
-            if self.value_type == bool:
-                return False if str(self.wme.ConvertToStringElement().GetValue()) == "false" else True
-            elif self.value_type == int:
-                return int(self.wme.ConvertToIntElement().GetValue())
-            elif self.value_type == float:
-                return float(self.wme.ConvertToFloatElement().GetValue())
-            elif self.value_type == str:
-                return str(self.wme.ConvertToStringElement().GetValue())
+            value_type = self.value_type
+            if value_type == bool:
+                return False if str(self.agent._sml(self.agent._sml(self.wme.ConvertToStringElement).GetValue)) == "false" else True
+            elif value_type == int:
+                return int(self.agent._sml(self.agent._sml(self.wme.ConvertToIntElement).GetValue))
+            elif value_type == float:
+                return float(self.agent._sml(self.agent._sml(self.wme.ConvertToFloatElement).GetValue))
+            elif value_type == str:
+                return str(self.agent._sml(self.agent._sml(self.wme.ConvertToStringElement).GetValue))
             else:
-                return self.agent._get_identifier(self.wme.ConvertToIdentifier())
+                return self.agent._get_identifier(self.agent._sml(self.wme.ConvertToIdentifier))
     def __init__(self, agent):
         self.agent = agent
         self.identifiers = {}
+        self.profiler = None
+        # only set while a profiled SoarEnvironment method is running
+        self.active_profiler = None
+    def _sml(self, method, *args):
+        if self.active_profiler is not None:
+            self.active_profiler.count("sml_calls")
+        return method(*args)
     @property
     def name(self):
-        return str(self.agent.GetAgentName())
+        return str(self._sml(self.agent.GetAgentName))
     @property
     def input_link(self):
-        return self._get_identifier(self.agent.GetInputLink())
+        return self._get_identifier(self._sml(self.agent.GetInputLink))
     @property
     def output_link(self):
         # this can be None if the agent has not put anything on the output link ever
-        ol = self.agent.GetOutputLink()
+        ol = self._sml(self.agent.GetOutputLink)
         if ol:
             return self._get_identifier(ol)
         else:
             return None
     def _get_identifier(self, identifier):
         assert isinstance(identifier, sml.Identifier)
-        if identifier.GetTimeTag() not in self.identifiers:
-            self.identifiers[identifier.GetTimeTag()] = Agent.Identifier(self, identifier)
-        return self.identifiers[identifier.GetTimeTag()]
+        time_tag = self._sml(identifier.GetTimeTag)
+        if time_tag not in self.identifiers:
+            self.identifiers[time_tag] = Agent.Identifier(self, identifier, time_tag)
+        return self.identifiers[time_tag]
     def _get_wme(self, wme):
         assert isinstance(wme, sml.WMElement)
         return Agent.WME(self, wme)
@@ -113,22 +124,28 @@ class Agent:
         assert isinstance(identifier, Agent.Identifier)
         assert isinstance(attribute, str)
         if isinstance(value, bool):
-            return self._get_wme(self.agent.CreateStringWME(identifier.wme, attribute, ("true" if value else "false")))
-        if isinstance(value, int):
-            return self._get_wme(self.agent.CreateIntWME(identifier.wme, attribute, value))
+            wme = self._sml(self.agent.CreateStringWME, identifier.wme, attribute, ("true" if value else "false"))
+        elif isinstance(value, int):
+            wme = self._sml(self.agent.CreateIntWME, identifier.wme, attribute, value)
         elif isinstance(value, float):
-            return self._get_wme(self.agent.CreateFloatWME(identifier.wme, attribute, value))
+            wme = self._sml(self.agent.CreateFloatWME, identifier.wme, attribute, value)
         elif isinstance(value, str):
-            return self._get_wme(self.agent.CreateStringWME(identifier.wme, attribute, value))
+            wme = self._sml(self.agent.CreateStringWME, identifier.wme, attribute, value)
         elif isinstance(value, Agent.Identifier):
-            return self._get_wme(self.agent.CreateSharedIdWME(identifier.wme, attribute, value))
+            wme = self._sml(self.agent.CreateSharedIdWME, identifier.wme, attribute, value)
         elif value is None:
-            return self._get_wme(self.agent.CreateIdWME(identifier.wme, attribute))
+            wme = self._sml(self.agent.CreateIdWME, identifier.wme, attribute)
         else:
             raise TypeError()
+        if wme is not None and self.active_profiler is not None:
+            self.active_profiler.count("wmes_created")
+        return self._get_wme(wme)
     def destroy_wme(self, wme):
         assert isinstance(wme, Agent.WME)
-        return bool(self.agent.DestroyWME(wme.wme))
+        destroyed = bool(self._sml(self.agent.DestroyWME, wme.wme))
+        if destroyed and self.active_profiler is not None:
+            self.active_profiler.count("wmes_destroyed")
+        return destroyed
     def execute_command_line(self, command):
         return str(self.agent.ExecuteCommandLine(command))
     def register_for_run_event(self, event, function, user_data):
@@ -201,6 +218,37 @@ def run_parameterized_commands(agent, parameters, commands):
 
 # environment template and example
 
+class IOProfiler:
+    # histogram keys are the lower bounds of power-of-two buckets in microseconds;
+    # sub-microsecond latencies go in bucket 0
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.times = defaultdict(float)
+        self.histograms = defaultdict(lambda: defaultdict(int))
+        self.counts = defaultdict(int)
+    def record(self, name, elapsed):
+        self.calls[name] += 1
+        self.times[name] += elapsed
+        microseconds = elapsed * 1000000
+        if microseconds < 1:
+            bucket = 0
+        else:
+            bucket = 2 ** (frexp(microseconds)[1] - 1)
+        self.histograms[name][bucket] += 1
+    def count(self, name, n=1):
+        self.counts[name] += n
+    def total_time(self, name):
+        return self.times.get(name, 0.0)
+    def histogram(self, name):
+        return dict(sorted(self.histograms.get(name, {}).items()))
+    def summary(self):
+        return {
+            "calls": dict(self.calls),
+            "times": dict((name, time * 1000) for name, time in self.times.items()),
+            "histograms": dict((name, self.histogram(name)) for name in self.histograms),
+            "counts": dict(self.counts),
+        }
+
 # FIXME would like to allow agent to send data back for the report
 
 class SoarEnvironment:
@@ -226,7 +274,31 @@ class SoarEnvironment:
     @abstractmethod
     def update_io(self):
         raise NotImplementedError()
+    @property
+    def profiler(self):
+        # kept on the agent so every environment sharing it is profiled together
+        return self.agent.profiler
+    def enable_profiling(self):
+        if self.agent.profiler is None:
+            self.agent.profiler = IOProfiler()
+        return self.agent.profiler
+    @contextmanager
+    def _profiled(self, name):
+        # the agent only counts SML calls while a profiled method is running
+        previous = self.agent.active_profiler
+        self.agent.active_profiler = self.profiler
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.profiler.record(name, perf_counter() - start)
+            self.agent.active_profiler = previous
     def del_wme(self, parent, attr, child):
+        if self.profiler is None:
+            return self._del_wme(parent, attr, child)
+        with self._profiled("del_wme"):
+            return self._del_wme(parent, attr, child)
+    def _del_wme(self, parent, attr, child):
         if (parent not in self.wmes) or (attr not in self.wmes[parent]) or (child not in self.wmes[parent][attr]):
             return False
         self.agent.destroy_wme(self.wmes[parent][attr][child])
@@ -237,6 +309,11 @@ class SoarEnvironment:
             del self.wmes[parent]
         return True
     def add_wme(self, parent, attr, child=None):
+        if self.profiler is None:
+            return self._add_wme(parent, attr, child)
+        with self._profiled("add_wme"):
+            return self._add_wme(parent, attr, child)
+    def _add_wme(self, parent, attr, child=None):
         if parent not in self.wmes:
             self.wmes[parent] = {}
         if attr not in self.wmes[parent]:
@@ -251,6 +328,11 @@ class SoarEnvironment:
             self.wmes[parent][attr][child] = new_wme
         return new_wme
     def parse_output_commands(self):
+        if self.profiler is None:
+            return self._parse_output_commands()
+        with self._profiled("parse_output_commands"):
+            return self._parse_output_commands()
+    def _parse_output_commands(self):
         commands = set()
         output_link = self.agent.output_link
         if output_link is not None:
@@ -261,11 +343,21 @@ class SoarEnvironment:
         return commands
     @staticmethod
     def update(mid, user_data, agent, message):
-        if not user_data.io_initialized:
-            user_data.initialize_io()
-            user_data.io_initialized = True
-        user_data.update_io()
-        agent.Commit()
+        if user_data.profiler is None:
+            user_data._update(agent)
+        else:
+            with user_data._profiled("update"):
+                user_data._update(agent)
+    def _update(self, agent):
+        if not self.io_initialized:
+            self.initialize_io()
+            self.io_initialized = True
+        self.update_io()
+        if self.profiler is None:
+            agent.Commit()
+        else:
+            with self._profiled("commit"):
+                self.agent._sml(agent.Commit)
 
 class Ticker(SoarEnvironment):
     def __init__(self, agent):
@@ -356,10 +448,11 @@ class SoarExperiment:
             self.environment_instance.initialize_io()
         def update_io(self):
             self.environment_instance.update_io()
-    def __init__(self, environment_class, commands, reporters, parameter_space=None):
+    def __init__(self, environment_class, commands, reporters, parameter_space=None, profile=False):
         self.environment_class = environment_class
         self.commands = commands
         self.reporters = reporters
+        self.profile = profile
         if parameter_space is not None:
             self.set_parameter_space(parameter_space)
         else:
@@ -384,6 +477,8 @@ class SoarExperiment:
         report.update(parameters)
         with create_agent() as agent:
             environment = SoarExperiment.ParameterizedSoarEnvironment(agent, self.environment_class, parameters)
+            if self.profile:
+                environment.enable_profiling()
             for f in self.prerun_procedures:
                 f(environment.environment_instance, parameters, agent)
             if repl:
@@ -488,6 +583,25 @@ def kernel_cpu_time(environment, parameters, agent):
     result = re.sub(".*Kernel CPU Time: *([0-9.]+).*", r"\1", agent.execute_command_line("stats"), flags=re.DOTALL)
     return float(result) * 1000
 
+def python_io_time(environment, parameters, agent):
+    if environment.profiler is None or "update" not in environment.profiler.calls:
+        return None
+    return environment.profiler.total_time("update") * 1000
+
+def io_overhead_fraction(environment, parameters, agent):
+    python_time = python_io_time(environment, parameters, agent)
+    if python_time is None:
+        return None
+    total_time = python_time + kernel_cpu_time(environment, parameters, agent)
+    if total_time == 0:
+        return 0.0
+    return python_time / total_time
+
+def python_io_profile(environment, parameters, agent):
+    if environment.profiler is None:
+        return None
+    return environment.profiler.summary()
+
 # utilities
 
 class NameSpace: